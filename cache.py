@@ -0,0 +1,96 @@
+import os
+import orjson
+import time
+import functools
+import inspect
+
+# --- 設定・定数 ---
+CACHE_DIR = os.environ.get("CACHE_DIR", ".cache")
+# True の場合はキャッシュを読まずに必ず取得し直す (書き込みは行う)
+FORCE_REFRESH = os.environ.get("FORCE_REFRESH") == "true"
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+_MISS = object()
+
+class FileCache:
+    """ファイルベースのTTLキャッシュ
+    .cache/{endpoint}/{key}.json に {ts, ttl, payload} を保存する
+    """
+    def __init__(self, base_dir=CACHE_DIR, force_refresh=FORCE_REFRESH):
+        self.base_dir = base_dir
+        self.force_refresh = force_refresh
+
+    def _path(self, endpoint, key):
+        return os.path.join(self.base_dir, endpoint, f"{key}.json")
+
+    def get(self, endpoint, key):
+        """有効期限内のキャッシュがあれば payload を返す (なければ _MISS)"""
+        if self.force_refresh:
+            return _MISS
+        try:
+            with open(self._path(endpoint, key), "rb") as f:
+                entry = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return _MISS
+        # 壊れたファイル・別の形式で保存されたファイルも「キャッシュなし」として扱う
+        if not isinstance(entry, dict):
+            return _MISS
+        try:
+            if time.time() - entry.get('ts', 0) > entry.get('ttl', 0):
+                return _MISS
+        except TypeError:
+            # ts / ttl が数値でない
+            return _MISS
+        return entry.get('payload')
+
+    def contains(self, endpoint, key):
+        """有効期限内のキャッシュがあるか"""
+        return self.get(endpoint, key) is not _MISS
+
+    def set(self, endpoint, key, payload, ttl):
+        path = self._path(endpoint, key)
+        try:
+            # yfinance の値に numpy のスカラーが混ざっても保存できるようにする
+            # (変換できない値は JSONEncodeError(TypeError) になる。一時ファイルを作る前に変換する)
+            data = orjson.dumps({'ts': time.time(), 'ttl': ttl, 'payload': payload},
+                                option=orjson.OPT_SERIALIZE_NUMPY)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+            tmp_path = f"{path}.{os.getpid()}.{id(payload)}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            # キャッシュの書き込み失敗で本処理は止めない
+            print(f"Cache write error ({endpoint}/{key}): {e}")
+
+    def cached(self, endpoint, ttl, should_cache=lambda v: v is not None):
+        """第1引数(銘柄コード)をキーにして戻り値をキャッシュするデコレータ
+        should_cache が False を返す値(取得失敗など)は保存しない
+        """
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(key, *args, **kwargs):
+                    value = self.get(endpoint, key)
+                    if value is not _MISS:
+                        return value
+                    value = await func(key, *args, **kwargs)
+                    if should_cache(value):
+                        self.set(endpoint, key, value, ttl)
+                    return value
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(key, *args, **kwargs):
+                value = self.get(endpoint, key)
+                if value is not _MISS:
+                    return value
+                value = func(key, *args, **kwargs)
+                if should_cache(value):
+                    self.set(endpoint, key, value, ttl)
+                return value
+            return wrapper
+        return decorator
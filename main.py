@@ -1,26 +1,44 @@
 import os
-import json
+import orjson
 import datetime
 import time
-import requests
-import gspread
+import asyncio
+import functools
+import html
 import jpholiday
-import yfinance as yf
 import random
 import re
-from bs4 import BeautifulSoup
-from oauth2client.service_account import ServiceAccountCredentials
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from collections import deque, namedtuple
 import traceback
-import pandas as pd # タイムスタンプ計算用に明示インポート
+from cache import FileCache, HOUR, DAY
+
+# 修正: yfinance / pandas / gspread などの重いモジュールは休場日判定の後で読み込む
+# (休場日は読み込まずに終了するので、数秒かかっていた起動がほぼ一瞬になる)
+def _import_heavy_modules():
+    global aiohttp, gspread, absolute_range_name, yf, YfData, YFRateLimitError
+    global curl_requests, ServiceAccountCredentials, pd, _YF_SESSION
+    import aiohttp
+    import gspread
+    from gspread.utils import absolute_range_name
+    import yfinance as yf
+    from yfinance.data import YfData
+    from yfinance.exceptions import YFRateLimitError
+    from curl_cffi import requests as curl_requests
+    from oauth2client.service_account import ServiceAccountCredentials
+    import pandas as pd # タイムスタンプ計算用に明示インポート
+
+    if _YF_SESSION is None:
+        _YF_SESSION = curl_requests.Session(impersonate="chrome")
 
 # --- 設定・定数 ---
 SECRETS_JSON_ENV = 'GCP_CREDENTIALS_JSON'
 MARKET_CAP_THRESHOLD = 500 * 100_000_000
 INVENTORY_RATIO_THRESHOLD = 0.3
 FINANCE_KEYWORDS = ["銀行業", "保険業", "証券", "商品先物", "金融業"]
+# 金融業判定用: キーワードを1本の正規表現にまとめ、業種文字列の走査を1回にする
+FINANCE_RE = re.compile("|".join(map(re.escape, FINANCE_KEYWORDS)))
 
 # ==========================================
 # ★ 設定: B/C列のスクレイピング・入力切替
@@ -29,6 +47,31 @@ FINANCE_KEYWORDS = ["銀行業", "保険業", "証券", "商品先物", "金融
 # ==========================================
 UPDATE_BC_WITH_SCRAPING = False
 
+# スクレイピング(aiohttp)の同時接続設定
+SCRAPE_CONCURRENCY = 8      # Yahoo JP への同時リクエスト数 (Semaphore)
+SCRAPE_CONN_LIMIT = 20      # コネクションプール全体の上限
+SCRAPE_CONN_PER_HOST = 10   # 1ホストあたりの接続上限
+# DNS の名前解決結果を保持する秒数 (aiohttp の既定は10秒)
+# ※ 銘柄名・業種が揃った時点で読むのをやめるため、その接続は使い回されずに閉じられる
+#   (残り200KB超を読み捨てて接続を残すより、読むのをやめる方が速い)。
+#   銘柄ごとに新しく接続するので、名前解決だけでも毎回やり直さないようにする
+SCRAPE_DNS_TTL = 300
+SCRAPE_RATE = 5             # Yahoo JP への1秒あたりの最大リクエスト数
+SCRAPE_TIMEOUT = 10           # 1リクエストのタイムアウト(秒)
+
+# 1バッチあたりの銘柄数 (進捗表示・時価総額の一括取得の単位)
+BATCH_SIZE = 50
+
+# yfinance 取得用のワーカースレッド数
+# 処理時間の大半はレスポンス待ち(300〜800ms)なので、CPU数ではなく同時接続数で決める
+# (curl_cffi の Session はスレッドごとに接続を持つため、接続数もこの値に揃う)
+MAX_WORKERS = int(os.environ.get("SCRAPE_WORKERS", "16"))
+# yfinance の取得関数(fast_info / info / BS / PL / 配当 / 一括株価)の1秒あたりの最大呼び出し回数
+# (全ワーカーで共有。Yahoo JP とは別枠)
+# ※ HTTPリクエスト数ではない。1回の呼び出しで複数のリクエストが飛ぶことがある
+#   (fast_info の時価総額は株数と株価履歴、info は crumb の取得など) ので、実際のリクエスト数はこの数倍になりうる
+YF_RATE = int(os.environ.get("YF_RATE", "5"))
+
 # 東証33業種リスト
 TSE_SECTORS = [
     "水産・農林業", "鉱業", "建設業", "食料品", "繊維製品", "パルプ・紙", "化学",
@@ -51,6 +94,36 @@ HEADER = [
     '営業利益(億)'                                  # ⑥生データ (追加)
 ]
 
+def col_letter(n):
+    """列番号(1始まり)を A1 表記の列名に変換する (1 -> A, 26 -> Z, 27 -> AA)"""
+    letters = ""
+    n -= 1
+    while n >= 0:
+        letters = chr(ord('A') + n % 26) + letters
+        n = n // 26 - 1
+    return letters
+
+# HEADER の最終列 (HEADER は B列から始まるので、列番号は 1 + len(HEADER))
+# 修正: chr() の足し算ではなく col_letter で求め、Z列を超えても正しい列名にする
+LAST_COL = col_letter(1 + len(HEADER))
+
+# パーセント表示(0.00%)にする列 (値は比率の数値のまま書き込む)
+PERCENT_COLUMNS = ['配当利回り', '配当性向', '棚卸資産比率']
+
+# 行データの型 (フィールドは HEADER と同じ並び)
+ROW_FIELDS = [
+    'name', 'industry',
+    'nc_ratio', 'nc_ratio_strict', 'nc_over_1', 'nc_strict_over_1',
+    'cn_per', 'div_yield', 'payout_ratio',
+    'exclude_fin', 'market_cap_oku', 'is_small',
+    'inv_warning', 'inv_ratio',
+    'current_assets_oku', 'inv_securities_oku', 'liabilities_oku',
+    'net_cash_oku', 'net_cash_strict_oku', 'inventory_oku',
+    'operating_income_oku',
+]
+Row = namedtuple("Row", ROW_FIELDS)
+EMPTY_ROW = Row(*[""] * len(HEADER))
+
 # User-Agentリスト
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -58,17 +131,91 @@ USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
 ]
 
-# Session作成
-def create_session():
-    session = requests.Session()
-    # 修正: totalを5回に増加、backoff_factorを2に増加（待機時間をより長く確保）
-    retry = Retry(
-        total=5, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]),
-    )
-    session.mount("https://", HTTPAdapter(max_retries=retry))
-    return session
-
-_HTTP_SESSION = create_session()
+# 銘柄名は <title> からしか取らないので、DOMは組み立てず正規表現で生HTMLから直接抜き出す
+# (Yahoo JP は UTF-8 固定なので、デコードせずバイト列のまま検索する)
+TITLE_RE = re.compile(rb"<title[^>]*>([^<]+)</title>", re.IGNORECASE)
+# 業種名もバイト列で検索する
+# 33業種を1本の正規表現にまとめ、業種ごとにページを走査し直さず1回の走査で見つける
+TSE_SECTORS_RE = re.compile(b"|".join(re.escape(s.encode("utf-8")) for s in TSE_SECTORS))
+PAGE_CHUNK_SIZE = 8192
+# 受信したチャンクごとに、新しく届いた部分 + 直前の末尾(チャンク境界をまたぐ一致用)だけを検索する
+# <title> 全体・業種名の最大長より長い重なりを取れば取りこぼさない
+TITLE_SCAN_OVERLAP = 1024
+SECTOR_SCAN_OVERLAP = max(len(s.encode("utf-8")) for s in TSE_SECTORS)
+
+# yfinance用の共有Session
+# 銘柄ごとに新しい接続を張らず、Yahooへの TCP/TLS 接続を全銘柄で使い回す
+# (curl_cffi を使うのは、Chrome の TLS 指紋を再現して Yahoo にブロックされにくくするため。
+#  yfinance は requests.Session も受け付けるが、requests_cache などのキャッシュ付き Session は受け付けない)
+# ※ User-Agent は impersonate が Chrome の TLS 指紋と一致するものを設定するので、上書きしない
+#   (USER_AGENTS の値に差し替えると指紋と食い違い、かえってブロックされやすくなる)
+# ※ 作成は _import_heavy_modules で行う
+_YF_SESSION = None
+
+# Yahoo JP / yfinance の取得結果のファイルキャッシュ (.cache/ 以下)
+_CACHE = FileCache()
+
+# 時価総額・現在株価の一括取得 (v7 quote API は1リクエストで複数銘柄を返す)
+QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+QUOTE_CHUNK_SIZE = 20
+# バッチ単位で一括取得した時価総額・現在株価 (シンボル -> {'market_cap', 'current_price'})
+_QUOTES = {}
+
+# fast_info の再試行
+# 429/5xx は指数的に待つ (Retry-After があればそれに従う)。
+# 一時的な404・通信エラー・値が取れない場合は短い待ちで再試行する
+FAST_INFO_RETRIES = 8
+RETRY_BASE_WAIT = 1.0
+RETRY_MAX_WAIT = 30.0
+RETRY_SHORT_WAIT = 0.5
+RETRY_SHORT_MAX_WAIT = 2.0
+
+def _retry_wait(error, attempt):
+    """再試行までの待ち時間(秒)を返す。再試行すべきでないエラーなら None
+    - 429・5xx: 指数バックオフ。Retry-After ヘッダーがあればその秒数を優先する
+    - ステータス無し(通信エラー・JSONの解析失敗・値が None など)・404: 短い待ちで再試行する
+      (一時的な404や空のレスポンスで、正常な銘柄を DATA_MISSING にしないため)
+    - その他の 4xx: 再試行しない
+    error に None を渡した場合 (例外は出ずに値が取れなかった場合) はステータス無しとして扱う
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if isinstance(error, YFRateLimitError) or status == 429 or (status or 0) >= 500:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), RETRY_MAX_WAIT)
+            except ValueError:
+                pass
+        # 指数バックオフ (1, 2, 4, ... 秒) + 同時に再試行が集中しないよう少しずらす
+        return min(RETRY_BASE_WAIT * (2 ** attempt), RETRY_MAX_WAIT) + random.uniform(0, 0.5)
+
+    if status is None or status == 404:
+        return min(RETRY_SHORT_WAIT * (attempt + 1), RETRY_SHORT_MAX_WAIT)
+    return None
+
+# BS/PL の項目名の候補 (ゆらぎ対応)。照合用に小文字化・空白除去は読み込み時に一度だけ行う
+def _normalize_keys(key_lists):
+    return {name: [k.strip().lower() for k in keys] for name, keys in key_lists.items()}
+
+_BS_KEYS = _normalize_keys({
+    'current_assets': ['Total Current Assets', 'Current Assets'],
+    'liabilities': ['Total Liabilities Net Minority Interest', 'Total Liabilities', 'Total Liab'],
+    'inventory': ['Inventory'],
+    'investments': ['Investments', 'Other Short Term Investments', 'Long Term Investments', 'Other Investments'],
+})
+_PL_KEYS = _normalize_keys({
+    'operating_income': ['Operating Income', 'Operating Profit'],
+    'basic_eps': ['Basic EPS'],
+})
+
+# 年末年始の休場日 (月, 日)
+NEW_YEAR_HOLIDAYS = {(12, 31), (1, 1), (1, 2), (1, 3)}
+
+@functools.lru_cache(maxsize=2)
+def _holidays_for(year):
+    """指定年の祝日を {日付: 祝日名} で返す (年ごとに1回だけ計算)"""
+    return dict(jpholiday.year_holidays(year))
 
 def is_market_closed():
     """休場日判定"""
@@ -76,35 +223,101 @@ def is_market_closed():
     if today.weekday() >= 5:
         print(f"Today is weekend ({today.strftime('%A')}). Exiting.")
         return True
-    if jpholiday.is_holiday(today):
-        print(f"Today is holiday ({jpholiday.is_holiday_name(today)}). Exiting.")
+    holiday_name = _holidays_for(today.year).get(today)
+    if holiday_name:
+        print(f"Today is holiday ({holiday_name}). Exiting.")
         return True
-    if (today.month == 12 and today.day == 31) or (today.month == 1 and today.day <= 3):
+    if (today.month, today.day) in NEW_YEAR_HOLIDAYS:
         print("Today is New Year holidays. Exiting.")
         return True
     return False
 
-def get_yahoo_jp_info(ticker_code):
+class RateLimiter:
+    """直近 per 秒間のリクエスト数を rate 以下に抑えるリミッタ (asyncio用)
+    ワーカーごとに固定で待つのではなく、枠が空いていれば即座に通す
+    """
+    def __init__(self, rate, per=1.0):
+        self.rate = rate
+        self.per = per
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                # 窓から外れた古いリクエストを捨てる
+                while self._calls and now - self._calls[0] >= self.per:
+                    self._calls.popleft()
+                if len(self._calls) < self.rate:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.per - (now - self._calls[0]))
+
+class ThreadRateLimiter:
+    """RateLimiter のスレッド版 (yfinance のワーカースレッドから使う)
+    直近 per 秒間の acquire() の回数を rate 以下に抑え、枠が空いていれば即座に通す
+    """
+    def __init__(self, rate, per=1.0):
+        self.rate = rate
+        self.per = per
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.per:
+                    self._calls.popleft()
+                if len(self._calls) < self.rate:
+                    self._calls.append(now)
+                    return
+                time.sleep(self.per - (now - self._calls[0]))
+
+# 修正: yfinance への問い合わせも全ワーカー共通の枠で、取得関数の秒間呼び出し回数を制限する
+# (キャッシュに当たった取得は問い合わせないので枠を使わない)
+_YF_LIMITER = ThreadRateLimiter(YF_RATE)
+
+# 銘柄名・業種はほぼ変わらないので90日キャッシュする (取得失敗は保存しない)
+@_CACHE.cached("yahoo_jp", ttl=90 * DAY, should_cache=lambda v: v[0] is not None and v[1] != "取得失敗")
+async def get_yahoo_jp_info(ticker_code, session, semaphore, limiter):
     """Yahoo!ファイナンス(JP)から銘柄名と業種を取得"""
     url = f"https://finance.yahoo.co.jp/quote/{ticker_code}.T"
     headers = {"User-Agent": random.choice(USER_AGENTS)}
     
-    # 修正: スクレイピング部分に強力なリトライループを追加
     # エラーが出ても、最大3回まで「長い休憩」を挟んで再挑戦する
     for i in range(3):
         try:
-            # 修正: 待機時間を 0.05-0.5秒 → 1.0-2.0秒 に大幅延長
-            time.sleep(random.uniform(1.0, 2.0))
-            
-            res = _HTTP_SESSION.get(url, headers=headers, timeout=10)
-            res.raise_for_status()
-            
-            res.encoding = res.apparent_encoding
-            html = res.text
-            soup = BeautifulSoup(html, 'html.parser')
+            # 修正: Semaphoreで同時接続数を、RateLimiterで秒間リクエスト数を制限する
+            # (固定のスリープは入れない)
+            async with semaphore:
+                await limiter.acquire()
+                async with session.get(url, headers=headers) as res:
+                    res.raise_for_status()
+                    # 修正: ページ全体(200KB超)を待たず、少しずつ読み込み、
+                    # 銘柄名(<title>)と業種が揃った時点で読むのをやめる
+                    buf = bytearray()
+                    title_match = None
+                    industry = None
+                    async for chunk in res.content.iter_chunked(PAGE_CHUNK_SIZE):
+                        # 修正: 毎回バッファ全体を先頭から検索し直さず、新しいチャンクの付近だけを検索する
+                        scan_from = len(buf)
+                        buf += chunk
+                        if title_match is None:
+                            title_match = TITLE_RE.search(buf, max(0, scan_from - TITLE_SCAN_OVERLAP))
+                        if industry is None:
+                            sector_match = TSE_SECTORS_RE.search(buf, max(0, scan_from - SECTOR_SCAN_OVERLAP))
+                            if sector_match is not None:
+                                industry = sector_match.group(0).decode("utf-8")
+                        if title_match is not None and industry is not None:
+                            break
 
             # 1. 銘柄名取得
-            title_text = soup.title.string if soup.title else ""
+            # 修正: DOMを組み立てず、コンパイル済み正規表現で <title> を取得
+            # (デコードするのはマッチした <title> の中身だけ)
+            # ※ HTMLパーサーを通さない分、&amp; などの文字参照はここで戻す
+            title_text = html.unescape(title_match.group(1).decode("utf-8", errors="replace")) if title_match else ""
             name = None
             if "【" in title_text:
                 name = title_text.split("【")[0]
@@ -112,11 +325,8 @@ def get_yahoo_jp_info(ticker_code):
                 name = title_text.split("：")[0]
 
             # 2. 業種取得
-            industry = "取得失敗"
-            for candidate in TSE_SECTORS:
-                if candidate in html:
-                    industry = candidate
-                    break
+            if industry is None:
+                industry = "取得失敗"
 
             return name.strip() if name else None, industry
 
@@ -126,304 +336,451 @@ def get_yahoo_jp_info(ticker_code):
                 print(f"Scraping Error for {ticker_code}: {e}")
                 return None, "取得失敗"
             else:
-                # 修正: エラー時は 5〜10秒 待機してサーバー負荷が下がるのを待つ
-                time.sleep(random.uniform(5.0, 10.0))
+                # エラー時は 5〜10秒 待機してサーバー負荷が下がるのを待つ
+                # (Semaphoreの外で待つので、他の銘柄の取得は止めない)
+                await asyncio.sleep(random.uniform(5.0, 10.0))
 
     return None, "取得失敗"
 
+# --- yfinance の取得単位ごとのキャッシュ ---
+# 更新頻度に合わせてTTLを分ける (BS/PLは四半期、配当は週、株価は毎日取り直す)
+# ※ 時価総額は日次実行で必ず取り直すよう、1日より短いTTLにする
+
+@_CACHE.cached("fast_info", ttl=12 * HOUR)
+def _fetch_fast_info(ticker_code, yf_ticker):
+    """時価総額・現在株価を取得 (取れなければ None)"""
+    # 即死トラップだった 404エラーチェック のブロックを完全に削除
+    # ※ Ticker作成前に HEAD で 404 を先読みする方式も同じ理由で採用しない
+    #   (一時的な404/リダイレクトで正常な銘柄まで DATA_MISSING になり、
+    #    正常な銘柄では毎回リクエストが1本増えるだけになるため)
+
+    # 一括取得済みならそれを使い、取れなかった銘柄だけ fast_info で個別に取得する
+    quote = _QUOTES.get(f"{ticker_code}.T".upper())
+    if quote is not None:
+        return quote
+
+    # 【対策1】時価総額・現在株価のリトライ取得
+    market_cap = None
+    current_price = None
+    
+    # 修正: fast_info は一度だけ取り出して使い回す
+    # (バージョンによってはプロパティに触れるたびに作り直され、取得がやり直しになる)
+    # バージョン揺れ対応
+    fast_info = getattr(yf_ticker, "fast_info", None)
+    if fast_info is None:
+        return None
+
+    # 修正: 固定の sleep(2+i) で8回待つのをやめ、エラーの種類に応じて待ち時間を変える (_retry_wait)
+    # (項目・属性が無い KeyError/AttributeError は何度やっても同じなので、すぐに諦める)
+    for i in range(FAST_INFO_RETRIES):
+        is_last = i == FAST_INFO_RETRIES - 1
+        try:
+            _YF_LIMITER.acquire()
+            market_cap = fast_info.market_cap
+            current_price = fast_info.last_price
+        except (KeyError, AttributeError) as e:
+            print(f"fast_info error for {ticker_code}: {e!r}")
+            break
+        except Exception as e:
+            wait = _retry_wait(e, i)
+            if wait is None or is_last:
+                print(f"fast_info error for {ticker_code}: {e!r}")
+                break
+            time.sleep(wait)
+            continue
+
+        if market_cap is not None:
+            break
+        # 例外は出ないが時価総額が取れなかった (株価履歴が空など) 場合も再試行する
+        if is_last:
+            print(f"fast_info error for {ticker_code}: market_cap is None")
+            break
+        time.sleep(_retry_wait(None, i))
+
+    # 取得できなかった場合は「データなし」と判定する
+    if market_cap is None:
+        return None
+    return {'market_cap': market_cap, 'current_price': current_price}
+
+@_CACHE.cached("name", ttl=90 * DAY)
+def _fetch_long_name(ticker_code, yf_ticker):
+    """英語名を取得 (取れなければ None)"""
+    try:
+        _YF_LIMITER.acquire()
+        return yf_ticker.info.get('longName')
+    except:
+        return None
+
+@_CACHE.cached("bs", ttl=90 * DAY)
+def _fetch_bs(ticker_code, yf_ticker):
+    """BSの最新期から必要な項目を取得 (BSが取れなければ None)"""
+    # 【対策3】年次データがない場合、四半期データへの切り替え
+    # 修正: プロパティではなく取得関数を明示的に呼び、結果は変数に持って使い回す
+    # (四半期は年次が本当に無いときだけ取得する)
+    # ※ 項目名の照合 (_BS_KEYS) はプロパティと同じ整形済みの名前で行うため pretty=True のまま
+    bs = None
+    try:
+        _YF_LIMITER.acquire()
+        bs = yf_ticker.get_balance_sheet(pretty=True, freq='yearly')
+        if bs is None or bs.empty:
+            _YF_LIMITER.acquire()
+            bs = yf_ticker.get_balance_sheet(pretty=True, freq='quarterly')
+    except:
+        pass
+
+    if bs is None or bs.empty:
+        return None
+
+    latest_date_bs = bs.columns[0]
+    latest_bs = bs[latest_date_bs]
+
+    # 【対策2】データ項目名の「ゆらぎ」対応（柔軟性）
+    # インデックスをすべて小文字化・空白除去し、値まで持つ dict を一度だけ作成
+    # (キーごとに pandas の Index 検索・ラベル解決を走らせない)
+    bs_map = {k.strip().lower(): v for k, v in latest_bs.items() if isinstance(k, str)}
+
+    def get_val_bs(name):
+        # 検索キーは _BS_KEYS で正規化済み
+        for k in _BS_KEYS[name]:
+            val = bs_map.get(k)
+            if val is not None:
+                if val != val: return None # NaN check
+                return float(val)
+        return None
+
+    inv_securities = 0.0
+    found_inv = get_val_bs('investments')
+    if found_inv is not None:
+        inv_securities = found_inv
+
+    return {
+        'total_current_assets': get_val_bs('current_assets'),
+        'total_liabilities': get_val_bs('liabilities'),
+        'inventory': get_val_bs('inventory') or 0.0,
+        'investment_securities': inv_securities,
+    }
+
+@_CACHE.cached("pl", ttl=90 * DAY, should_cache=lambda v: v is not None and v['has_pl'])
+def _fetch_pl(ticker_code, yf_ticker):
+    """PLの最新期から営業利益・EPSを取得 (PLが取れなければ 0.0)"""
+    operating_income = 0.0
+    basic_eps = 0.0
+    
+    _YF_LIMITER.acquire()
+    fin = yf_ticker.get_income_stmt(pretty=True, freq='yearly')
+    if fin is None or fin.empty:
+        # PLも四半期へフォールバック
+        _YF_LIMITER.acquire()
+        fin = yf_ticker.get_income_stmt(pretty=True, freq='quarterly')
+
+    has_pl = fin is not None and not fin.empty
+    if has_pl:
+        latest_date_pl = fin.columns[0]
+        latest_fin = fin[latest_date_pl]
+        
+        # PL用のゆらぎ対応マップ
+        pl_map = {k.strip().lower(): v for k, v in latest_fin.items() if isinstance(k, str)}
+
+        def get_val_pl(name):
+            for k in _PL_KEYS[name]:
+                val = pl_map.get(k)
+                if val is not None:
+                    if val != val: return 0.0
+                    return float(val)
+            return 0.0
+        
+        # 営業利益
+        operating_income = get_val_pl('operating_income')
+        # EPS (配当性向用)
+        basic_eps = get_val_pl('basic_eps')
+
+    return {'operating_income': operating_income, 'basic_eps': basic_eps, 'has_pl': has_pl}
+
+# ※ yfinance は株価履歴の取得に失敗しても(レート制限以外は)空の配当を返すため、
+#   配当0 は取得失敗と区別できない。誤った 0 を1週間使い続けないよう、0 は保存せず毎回取り直す
+@_CACHE.cached("dividends", ttl=7 * DAY, should_cache=lambda v: v is not None and v > 0)
+def _fetch_dividends(ticker_code, yf_ticker):
+    """過去1年間の配当合計を取得 (取得失敗時は None)"""
+    try:
+        _YF_LIMITER.acquire()
+        divs = yf_ticker.dividends
+        if divs.empty:
+            return 0.0
+        # タイムゾーン考慮: 今から1年前
+        one_year_ago = pd.Timestamp.now(tz=divs.index.tz) - pd.DateOffset(years=1)
+        # 修正: 配当は日付の昇順に並んでいるので、真偽値マスクを作らず二分探索で位置を求めて切り出す
+        start = divs.index.searchsorted(one_year_ago)
+        return float(divs.values[start:].sum())
+    except:
+        return None
+
+# 同一実行内でA列に同じ銘柄が重複していても、yfinanceへの問い合わせは1回にする
+# (別のバッチにある重複はこのキャッシュで、同じバッチ内の重複は process_batch_async でまとめる。
+#  lru_cache は実行中の呼び出しを共有しないので、同時に走る重複はここでは防げない)
+@functools.lru_cache(maxsize=4096)
 def get_financial_data(ticker_code, jp_name_failed=False):
-    """yfinanceから財務データ(BS/PL/Div)を取得して計算"""
+    """yfinanceから財務データ(BS/PL/Div)を取得
+    取得単位ごとにファイルキャッシュを使い、有効期限内であれば通信しない
+    """
     target_ticker = f"{ticker_code}.T"
-    yf_ticker = yf.Ticker(target_ticker)
+    yf_ticker = yf.Ticker(target_ticker, session=_YF_SESSION)
     
     fallback_name = None
 
     try:
-        # 即死トラップだった 404エラーチェック のブロックを完全に削除
-
-        # 【対策1】時価総額・現在株価のリトライ取得
-        market_cap = None
-        current_price = None
-        
-        for i in range(8): 
-            try:
-                # バージョン揺れ対応
-                if hasattr(yf_ticker, "fast_info"):
-                    # ここでエラーが出ても except に飛んで正しくリトライ（待機）される
-                    market_cap = yf_ticker.fast_info.market_cap
-                    current_price = yf_ticker.fast_info.last_price
-                
-                if market_cap is not None:
-                    break
-            except:
-                pass
-            
-            # エラー時は待機して再試行
-            time.sleep(2.0 + i) 
-
-        # 8回リトライしてもダメだった場合のみ「データなし」と判定する
-        if market_cap is None:
+        price = _fetch_fast_info(ticker_code, yf_ticker)
+        if price is None:
              return {'status': 'DATA_MISSING', 'fallback_name': fallback_name}
+        market_cap = price['market_cap']
 
         # 英語名フォールバック
         if jp_name_failed:
-            try:
-                fallback_name = yf_ticker.info.get('longName')
-            except:
-                pass
+            fallback_name = _fetch_long_name(ticker_code, yf_ticker)
 
         # --- 1. BS取得 (安全性指標) ---
-        # 【対策3】年次データがない場合、四半期データへの切り替え
-        bs = None
-        try:
-            bs = yf_ticker.balance_sheet
-            if bs is None or bs.empty:
-                bs = yf_ticker.quarterly_balance_sheet
-        except:
-            pass
-
-        if bs is None or bs.empty:
+        bs = _fetch_bs(ticker_code, yf_ticker)
+        if bs is None:
             return None
 
-        latest_date_bs = bs.columns[0]
-        latest_bs = bs[latest_date_bs]
-
-        # 【対策2】データ項目名の「ゆらぎ」対応（柔軟性）
-        # インデックスをすべて小文字化・空白除去してマッピングを作成
-        bs_idx_map = {str(k).strip().lower(): k for k in latest_bs.index}
-
-        def get_val_bs(key_list):
-            for k in key_list:
-                # 検索キーも正規化して探す
-                search_key = str(k).strip().lower()
-                if search_key in bs_idx_map:
-                    real_key = bs_idx_map[search_key]
-                    val = latest_bs[real_key]
-                    if hasattr(val, "item"): 
-                        if val != val: return None # NaN check
-                        return float(val)
-                    return float(val)
-            return None
-
-        total_assets_curr = get_val_bs(['Total Current Assets', 'Current Assets'])
-        total_liab = get_val_bs(['Total Liabilities Net Minority Interest', 'Total Liabilities', 'Total Liab'])
-        inventory = get_val_bs(['Inventory']) or 0.0
-        
-        inv_securities = 0.0
-        found_inv = get_val_bs(['Investments', 'Other Short Term Investments', 'Long Term Investments', 'Other Investments'])
-        if found_inv is not None:
-            inv_securities = found_inv
-        
         # --- 2. PL取得 (実質PER用) ---
-        operating_income = 0.0
-        basic_eps = 0.0
-        
-        fin = yf_ticker.financials
-        if fin is None or fin.empty:
-            # PLも四半期へフォールバック
-            fin = yf_ticker.quarterly_financials
-
-        if fin is not None and not fin.empty:
-            latest_date_pl = fin.columns[0]
-            latest_fin = fin[latest_date_pl]
-            
-            # PL用のゆらぎ対応マップ
-            pl_idx_map = {str(k).strip().lower(): k for k in latest_fin.index}
-
-            def get_val_pl(key_list):
-                for k in key_list:
-                    search_key = str(k).strip().lower()
-                    if search_key in pl_idx_map:
-                        real_key = pl_idx_map[search_key]
-                        val = latest_fin[real_key]
-                        if hasattr(val, "item"):
-                             if val != val: return 0.0
-                             return float(val)
-                        return float(val)
-                return 0.0
-            
-            # 営業利益
-            operating_income = get_val_pl(['Operating Income', 'Operating Profit'])
-            # EPS (配当性向用)
-            basic_eps = get_val_pl(['Basic EPS'])
+        pl = _fetch_pl(ticker_code, yf_ticker)
 
         # --- 3. 配当取得 (カタリスト用) ---
-        # 過去1年間の配当合計を計算
-        annual_dividend = 0.0
-        try:
-            divs = yf_ticker.dividends
-            if not divs.empty:
-                # タイムゾーン考慮: 今から1年前
-                one_year_ago = pd.Timestamp.now(tz=divs.index.tz) - pd.DateOffset(years=1)
-                recent_divs = divs[divs.index >= one_year_ago]
-                annual_dividend = recent_divs.sum()
-        except:
-            pass
-
-        # --- 計算処理 ---
-        
+        annual_dividend = _fetch_dividends(ticker_code, yf_ticker) or 0.0
+
         # 欠損チェック (BS必須)
-        if market_cap is None or total_assets_curr is None or total_liab is None:
+        if bs['total_current_assets'] is None or bs['total_liabilities'] is None:
             return {
                 'market_cap': market_cap,
                 'status': 'DATA_MISSING',
                 'fallback_name': fallback_name
             }
 
-        # 安全性: NetCash
-        net_cash = total_assets_curr + (inv_securities * 0.7) - total_liab
-        # 安全性: 厳格NetCash (棚卸除外)
-        net_cash_strict = (total_assets_curr - inventory) + (inv_securities * 0.7) - total_liab
-
-        # 比率計算
-        nc_ratio = 0
-        nc_ratio_strict = 0
-        if market_cap:
-            nc_ratio = net_cash / market_cap
-            nc_ratio_strict = net_cash_strict / market_cap
-        
-        inv_ratio = (inventory / total_assets_curr) if total_assets_curr else 0
-
-        # 収益性: 実質PER (CN-PER) = (時価総額 - 厳格NC) / (営業利益 * 0.65)
-        # ※営業利益が赤字、または0の場合は計算不可(None)とする
-        cn_per = None
-        op_after_tax = operating_income * 0.65
-        if op_after_tax > 0 and market_cap:
-            # 分子がマイナス(現金の方が多い)なら、CN-PERはマイナスになる(正しい挙動)
-            cn_per = (market_cap - net_cash_strict) / op_after_tax
-        
-        # カタリスト: 配当利回り & 性向
-        div_yield = 0.0
-        payout_ratio = 0.0
-        
-        if current_price and current_price > 0:
-            div_yield = annual_dividend / current_price
-            
-        if basic_eps > 0:
-            payout_ratio = annual_dividend / basic_eps
-
+        # 指標の計算はバッチ単位で build_rows がまとめて行うため、ここでは生データのみ返す
         return {
             'status': 'OK',
             'market_cap': market_cap,
-            'total_current_assets': total_assets_curr,
-            'total_liabilities': total_liab,
-            'inventory': inventory,
-            'investment_securities': inv_securities,
-            'net_cash': net_cash,
-            'net_cash_strict': net_cash_strict,
-            'nc_ratio': nc_ratio,
-            'nc_ratio_strict': nc_ratio_strict,
-            'inv_ratio': inv_ratio,
+            'current_price': price['current_price'],
+            'total_current_assets': bs['total_current_assets'],
+            'total_liabilities': bs['total_liabilities'],
+            'inventory': bs['inventory'],
+            'investment_securities': bs['investment_securities'],
             'fallback_name': fallback_name,
-            # 追加項目
-            'cn_per': cn_per,
-            'div_yield': div_yield,
-            'payout_ratio': payout_ratio,
-            'operating_income': operating_income
+            'operating_income': pl['operating_income'],
+            'basic_eps': pl['basic_eps'],
+            'annual_dividend': annual_dividend
         }
 
     except Exception as e:
         print(f"yfinance Error {ticker_code}: {e}")
         return {'status': 'ERROR'}
 
-def process_ticker_wrapper(code_raw):
+def normalize_code(code_raw):
+    """A列の値を銘柄コード文字列に変換 (文字列変換と ".0" の除去)"""
+    code_str = str(code_raw).strip()
+    if code_str.endswith(".0"):
+        code_str = code_str[:-2]
+    return code_str
+
+def prefetch_quotes(codes):
+    """バッチ内の銘柄の時価総額・現在株価を QUOTE_CHUNK_SIZE 銘柄ずつまとめて取得しておく
+    (キャッシュが有効な銘柄は除く。失敗した分は _fetch_fast_info が個別に取得する)
+    """
+    _QUOTES.clear()
+    # A列で重複している銘柄は1回だけ問い合わせる (順序は保つ)
+    symbols = list(dict.fromkeys(f"{c}.T" for c in codes if c and not _CACHE.contains("fast_info", c)))
+    if not symbols:
+        return
+    # Cookie/crumb の処理は yfinance に任せるため、yfinance 共通のデータ取得窓口を使う
+    data = YfData(session=_YF_SESSION)
+    for i in range(0, len(symbols), QUOTE_CHUNK_SIZE):
+        chunk = symbols[i:i + QUOTE_CHUNK_SIZE]
+        try:
+            _YF_LIMITER.acquire()
+            res = data.get_raw_json(QUOTE_URL, params={"symbols": ",".join(chunk), "formatted": "false"})
+        except Exception as e:
+            print(f"Quote prefetch error ({chunk[0]} - {chunk[-1]}): {e}")
+            continue
+        for q in (res.get("quoteResponse") or {}).get("result") or []:
+            market_cap = q.get("marketCap")
+            if q.get("symbol") and market_cap:
+                _QUOTES[q["symbol"].upper()] = {
+                    'market_cap': float(market_cap),
+                    'current_price': q.get("regularMarketPrice"),
+                }
+
+async def process_ticker_async(code_raw, session, semaphore, limiter, executor):
     # 【対策4】待機時間（スリープ）の配置戦略
-    # 修正: 設定がONの場合のみ、待機とスクレイピングを実行
+    # 修正: スクレイピングは asyncio で並行実行し、間隔の制御は get_yahoo_jp_info の RateLimiter で行う
     
     name_jp = None
     industry_jp = "-"
     
-    if UPDATE_BC_WITH_SCRAPING:
-        # 待機時間を 2.0〜4.0秒 に拡大
-        time.sleep(random.uniform(2.0, 4.0))
-        
-        # 文字列変換と ".0" の除去
-        code_str = str(code_raw).strip()
-        if code_str.endswith(".0"):
-            code_str = code_str[:-2]
+    code_str = normalize_code(code_raw)
+    if not code_str:
+        # 空行 (要素数の調整は build_rows で行う)
+        return None
 
-        if not code_str:
-            return [""] * len(HEADER)
-        
+    if UPDATE_BC_WITH_SCRAPING:
         # A. Yahoo JP スクレイピング
-        name_jp, industry_jp = get_yahoo_jp_info(code_str)
-    else:
-        # OFFの場合はスクレイピング関連をスキップ
-        code_str = str(code_raw).strip()
-        if code_str.endswith(".0"):
-            code_str = code_str[:-2]
-        if not code_str:
-            # OFF時も要素数は合わせる必要があるが、戻り値で調整する
-             return [""] * (len(HEADER) - 2)
-
-    # B. yfinance データ取得
-    fin_data = get_financial_data(code_str, jp_name_failed=(name_jp is None))
-    
-    # C. データ整形
-    row_data = [""] * len(HEADER)
+        name_jp, industry_jp = await get_yahoo_jp_info(code_str, session, semaphore, limiter)
+
+    # B. yfinance データ取得 (同期APIのためスレッドプールで実行)
+    loop = asyncio.get_running_loop()
+    fin_data = await loop.run_in_executor(executor, get_financial_data, code_str, name_jp is None)
     
-    final_name = name_jp
-    if not final_name and fin_data and fin_data.get('fallback_name'):
-        final_name = fin_data['fallback_name']
-    if not final_name:
-        final_name = "取得失敗"
-
-    row_data[0] = final_name
-    row_data[1] = industry_jp
-
-    if fin_data and fin_data['status'] == 'OK':
-        is_exclude_fin = any(k in industry_jp for k in FINANCE_KEYWORDS)
-        is_small = fin_data['market_cap'] <= MARKET_CAP_THRESHOLD
-        is_inv_red = fin_data['inv_ratio'] >= INVENTORY_RATIO_THRESHOLD
-        is_nc_over_1 = fin_data['nc_ratio'] >= 1.0
-        is_nc_strict_over_1 = fin_data['nc_ratio_strict'] >= 1.0
-        
+    return {'name_jp': name_jp, 'industry_jp': industry_jp, 'fin_data': fin_data}
+
+# build_rows で DataFrame にする get_financial_data の生データ項目
+RAW_FIELDS = [
+    'market_cap', 'current_price', 'total_current_assets', 'total_liabilities',
+    'inventory', 'investment_securities', 'operating_income', 'basic_eps', 'annual_dividend',
+]
+
+# 小数点以下の桁数を揃える列 (それ以外の数値列はそのまま書き込む)
+ROUND_DIGITS = {
+    'nc_ratio': 2, 'nc_ratio_strict': 2, 'cn_per': 1, 'market_cap_oku': 1,
+    'current_assets_oku': 1, 'inv_securities_oku': 1, 'liabilities_oku': 1,
+    'net_cash_oku': 1, 'net_cash_strict_oku': 1, 'inventory_oku': 1, 'operating_income_oku': 1,
+}
+
+def build_rows(records):
+    """取得結果からシート書き込み用の行データを作成
+    指標計算は銘柄ごとではなく、バッチ全体を DataFrame の列演算でまとめて行う
+    """
+    rows = []
+    ok_indices = []
+    for record in records:
+        if record is None:
+            # A列が空の行
+            rows.append(EMPTY_ROW)
+            continue
+
+        fin_data = record['fin_data']
+        final_name = record['name_jp']
+        if not final_name and fin_data and fin_data.get('fallback_name'):
+            final_name = fin_data['fallback_name']
+        if not final_name:
+            final_name = "取得失敗"
+
+        if fin_data and fin_data['status'] == 'OK':
+            # 指標の列は下でまとめて埋める
+            ok_indices.append(len(rows))
+            rows.append(EMPTY_ROW._replace(name=final_name, industry=record['industry_jp']))
+        else:
+            rows.append(EMPTY_ROW._replace(
+                name=final_name if final_name != "取得失敗" else "データ取得失敗",
+                industry=record['industry_jp'],
+                nc_ratio="ERROR/MISSING",
+            ))
+
+    if ok_indices:
+        # None は NaN になる
+        df = pd.DataFrame.from_records(
+            [records[i]['fin_data'] for i in ok_indices], columns=RAW_FIELDS
+        ).astype(float)
+
+        # 安全性: NetCash
+        net_cash = df.total_current_assets + (df.investment_securities * 0.7) - df.total_liabilities
+        # 安全性: 厳格NetCash (棚卸除外)
+        net_cash_strict = net_cash - df.inventory
+
+        # 比率計算 (時価総額・流動資産が0の銘柄は0とする)
+        has_mcap = df.market_cap != 0
+        out = pd.DataFrame(index=df.index)
+        out['nc_ratio'] = (net_cash / df.market_cap).where(has_mcap, 0.0)
+        out['nc_ratio_strict'] = (net_cash_strict / df.market_cap).where(has_mcap, 0.0)
+        out['nc_over_1'] = out.nc_ratio >= 1.0
+        out['nc_strict_over_1'] = out.nc_ratio_strict >= 1.0
+
+        # 収益性: 実質PER (CN-PER) = (時価総額 - 厳格NC) / (営業利益 * 0.65)
+        # ※営業利益が赤字、または0の場合は計算不可("-")とする
+        # 分子がマイナス(現金の方が多い)なら、CN-PERはマイナスになる(正しい挙動)
+        op_after_tax = df.operating_income * 0.65
+        has_cn_per = (op_after_tax > 0) & has_mcap
+        out['cn_per'] = ((df.market_cap - net_cash_strict) / op_after_tax).where(has_cn_per)
+
+        # カタリスト: 配当利回り & 性向
+        out['div_yield'] = (df.annual_dividend / df.current_price).where(df.current_price > 0, 0.0)
+        out['payout_ratio'] = (df.annual_dividend / df.basic_eps).where(df.basic_eps > 0, 0.0)
+
+        # フィルタ (金融業は業種文字列での判定のため銘柄ごとに行う)
+        out['exclude_fin'] = [bool(FINANCE_RE.search(records[i]['industry_jp'])) for i in ok_indices]
         # 単位変換用 (億円)
         to_oku = 100_000_000
+        out['market_cap_oku'] = df.market_cap / to_oku
+        out['is_small'] = df.market_cap <= MARKET_CAP_THRESHOLD
 
-        # 安全性
-        row_data[2] = round(fin_data['nc_ratio'], 2)
-        row_data[3] = round(fin_data['nc_ratio_strict'], 2)
-        row_data[4] = is_nc_over_1
-        row_data[5] = is_nc_strict_over_1
-        
-        # 収益性・カタリスト (追加)
-        cn_per_val = fin_data['cn_per']
-        row_data[6] = round(cn_per_val, 1) if cn_per_val is not None else "-"
-        
-        # 修正: 文字列フォーマットを廃止し、数値をそのまま出力
-        row_data[7] = fin_data['div_yield']
-        row_data[8] = fin_data['payout_ratio']
-
-        # フィルタ
-        row_data[9] = is_exclude_fin
-        row_data[10] = round(fin_data['market_cap'] / to_oku, 1)
-        row_data[11] = is_small
-        
         # 在庫
-        row_data[12] = is_inv_red
-        # 修正: 文字列フォーマットを廃止し、数値をそのまま出力
-        row_data[13] = fin_data['inv_ratio']
-        
-        # 財務数値 (億円)
-        row_data[14] = round(fin_data['total_current_assets'] / to_oku, 1)
-        row_data[15] = round(fin_data['investment_securities'] / to_oku, 1)
-        row_data[16] = round(fin_data['total_liabilities'] / to_oku, 1)
-        row_data[17] = round(fin_data['net_cash'] / to_oku, 1)
-        row_data[18] = round(fin_data['net_cash_strict'] / to_oku, 1)
-        row_data[19] = round(fin_data['inventory'] / to_oku, 1)
-        row_data[20] = round(fin_data['operating_income'] / to_oku, 1) # 追加
-    
-    else:
-        row_data[0] = final_name if final_name != "取得失敗" else "データ取得失敗"
-        row_data[2] = "ERROR/MISSING"
+        inv_ratio = (df.inventory / df.total_current_assets).where(df.total_current_assets != 0, 0.0)
+        out['inv_warning'] = inv_ratio >= INVENTORY_RATIO_THRESHOLD
+        out['inv_ratio'] = inv_ratio
 
-    # 設定に応じて戻り値を変更
+        # 財務数値 (億円)
+        out['current_assets_oku'] = df.total_current_assets / to_oku
+        out['inv_securities_oku'] = df.investment_securities / to_oku
+        out['liabilities_oku'] = df.total_liabilities / to_oku
+        out['net_cash_oku'] = net_cash / to_oku
+        out['net_cash_strict_oku'] = net_cash_strict / to_oku
+        out['inventory_oku'] = df.inventory / to_oku
+        out['operating_income_oku'] = df.operating_income / to_oku
+
+        out = out.round(ROUND_DIGITS)
+        # 実質PERが計算不可の銘柄は "-"
+        out['cn_per'] = out.cn_per.astype(object).where(has_cn_per, "-")
+
+        # HEADER の index 2 以降の並び順に揃え、最後にPythonの値へ戻す
+        values_list = out[ROW_FIELDS[2:]].astype(object).values.tolist()
+        for i, values in zip(ok_indices, values_list):
+            rows[i] = Row(rows[i].name, rows[i].industry, *values)
+
+    # 設定に応じて戻り値を変更 (gspread に渡すため list に戻す)
     if UPDATE_BC_WITH_SCRAPING:
-        return row_data
+        return [list(row_data) for row_data in rows]
     else:
         # B, C列(index 0, 1)を除外して、NC比率以降を返す
-        return row_data[2:]
+        return [list(row_data[2:]) for row_data in rows]
+
+async def process_batch_async(batch_tickers, session, semaphore, limiter, executor):
+    """バッチ内の銘柄を並行処理し、入力順に行データを返す"""
+    codes = [normalize_code(code) for code in batch_tickers]
+    # 修正: 一括取得は通信・レート制限の待ちでブロックするので、イベントループを止めないようワーカースレッドで行う
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, prefetch_quotes, codes)
+    # 修正: バッチ内で重複している銘柄は1回だけ処理し、結果を各行に割り当てる
+    # (同時に実行すると lru_cache が効かず、同じ銘柄を二重に取得してしまうため)
+    unique_codes = list(dict.fromkeys(codes))
+    tasks = [process_ticker_async(code, session, semaphore, limiter, executor) for code in unique_codes]
+    results = dict(zip(unique_codes, await asyncio.gather(*tasks)))
+    records = [results[code] for code in codes]
+    return build_rows(records)
+
+async def process_all_async(tickers):
+    """全銘柄をバッチに分けて処理し、全行データを返す
+    aiohttp の Session・Semaphore・RateLimiter と yfinance 用のスレッドプールは実行全体で1つにし、
+    同時接続数・秒間リクエスト数の制限とスレッドごとの curl ハンドルをバッチをまたいで共有する
+    ※ Yahoo JP への接続は、途中で読むのをやめるため1リクエストごとに閉じられる (SCRAPE_DNS_TTL 参照)
+    """
+    connector = aiohttp.TCPConnector(
+        limit=SCRAPE_CONN_LIMIT, limit_per_host=SCRAPE_CONN_PER_HOST, ttl_dns_cache=SCRAPE_DNS_TTL,
+    )
+    semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    limiter = RateLimiter(SCRAPE_RATE)
+
+    total_tickers = len(tickers)
+    all_rows = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=SCRAPE_TIMEOUT)) as session:
+            for current_index in range(0, total_tickers, BATCH_SIZE):
+                end_index = min(current_index + BATCH_SIZE, total_tickers)
+                batch_tickers = tickers[current_index:end_index]
+                
+                print(f"Processing batch: {current_index + 1} - {end_index} / {total_tickers}")
+                
+                # 修正: バッチごとの書き込みと待機を廃止し、結果はメモリに溜める
+                # (OFF時、行の中身はすでに build_rows で短くなっている)
+                all_rows.extend(await process_batch_async(batch_tickers, session, semaphore, limiter, executor))
+    return all_rows
 
 def main():
     force_run = os.environ.get("FORCE_RUN") == "true"
@@ -433,11 +790,13 @@ def main():
     elif is_market_closed():
         return
 
+    _import_heavy_modules()
+
     secrets_json = os.environ.get(SECRETS_JSON_ENV)
     if not secrets_json:
         raise ValueError(f"Environment variable {SECRETS_JSON_ENV} not found.")
 
-    creds_dict = json.loads(secrets_json)
+    creds_dict = orjson.loads(secrets_json)
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
@@ -445,66 +804,67 @@ def main():
     sheet_url = creds_dict.get('spreadsheet_url')
     sheet_name = creds_dict.get('sheet_name')
     spreadsheet = client.open_by_url(sheet_url)
-    worksheet = spreadsheet.worksheet(sheet_name)
 
-    col_a = worksheet.col_values(1)
-    tickers = col_a[1:] 
+    # 修正: A列も values.batchGet で読み込み、worksheet の取得・col_values の呼び出しを省く
+    # (値の読み書きは読み込み1回・書き込み1回。別途、最後に表示形式の設定でシート情報の取得と
+    #  書式の書き込みが1回ずつ入る)
+    value_ranges = spreadsheet.values_batch_get(
+        [absolute_range_name(sheet_name, "A2:A")], params={'majorDimension': 'COLUMNS'}
+    ).get('valueRanges', [])
+    tickers = (value_ranges[0].get('values') or [[]])[0] if value_ranges else []
     if not tickers:
         print("No tickers found in column A.")
         return
 
-    # 修正: ヘッダー書き込み位置の調整
+    # 修正: ヘッダー・データの書き込み範囲 (書き込み自体は最後に1回だけ行う)
     if UPDATE_BC_WITH_SCRAPING:
-        header_range = f"B1:{chr(65 + len(HEADER))}1"
-        worksheet.update(range_name=header_range, values=[HEADER])
+        # B列から全て
+        header_values = HEADER
+        start_col = "B"
     else:
         # D列('NC比率')以降のヘッダーのみ更新
         # HEADER[2]は'NC比率'。B, Cをスキップするので D1から開始。
-        # A(1), B(2), C(3), D(4) -> len(HEADER)-2 列分
         # HEADER[2:] を書き込む
-        partial_header = HEADER[2:]
-        # D列は chr(68)
-        header_range = f"D1:{chr(68 + len(partial_header) - 1)}1"
-        worksheet.update(range_name=header_range, values=[partial_header])
+        header_values = HEADER[2:]
+        start_col = "D"
+    # どちらの場合も書き込みの右端は HEADER の最終列 (LAST_COL)
+    header_range = f"{start_col}1:{LAST_COL}1"
 
     print(f"Start processing {len(tickers)} tickers... (Scraping: {UPDATE_BC_WITH_SCRAPING})")
 
-    BATCH_SIZE = 50
-    total_tickers = len(tickers)
-    current_index = 0
-
-    while current_index < total_tickers:
-        end_index = min(current_index + BATCH_SIZE, total_tickers)
-        batch_tickers = tickers[current_index:end_index]
-        
-        print(f"Processing batch: {current_index + 1} - {end_index} / {total_tickers}")
-        
-        batch_rows = []
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            results = executor.map(process_ticker_wrapper, batch_tickers)
-            batch_rows = list(results)
-
-        if batch_rows:
-            start_row = current_index + 2
-            end_row = start_row + len(batch_rows) - 1
-            
-            # 修正: データ書き込み位置の調整
-            if UPDATE_BC_WITH_SCRAPING:
-                # B列から全て
-                data_range = f"B{start_row}:{chr(65 + len(HEADER))}{end_row}"
-            else:
-                # D列から、NC比率以降のみ
-                # batch_rowsの中身はすでに process_ticker_wrapper で短くなっている
-                data_range = f"D{start_row}:{chr(68 + len(batch_rows[0]) - 1)}{end_row}"
-            
-            try:
-                worksheet.update(range_name=data_range, values=batch_rows)
-                time.sleep(2)
-            except Exception as e:
-                print(f"Sheet write error at batch index {current_index}: {e}")
-
-        current_index += BATCH_SIZE
-        time.sleep(2)
+    all_rows = asyncio.run(process_all_async(tickers))
+
+    # 修正: ヘッダーとデータを1回の values.batchUpdate でまとめて書き込む
+    # (Sheets API の書き込みリクエストは実行全体で1回になる)
+    data_range = f"{start_col}2:{LAST_COL}{1 + len(all_rows)}"
+    # 値は数値・真偽値のまま渡すので、RAW で書き込みサーバー側での解釈(数式・日付の判定)を省く
+    # ※ 行末の空セルは削らない (RAW では空文字を送らないと前回実行の値が残るため)
+    spreadsheet.values_batch_update({
+        'valueInputOption': 'RAW',
+        'data': [
+            {'range': absolute_range_name(sheet_name, header_range), 'values': [header_values]},
+            {'range': absolute_range_name(sheet_name, data_range), 'values': all_rows},
+        ],
+    })
+
+    # 修正: 比率の列は "30.00%" のような文字列にせず、表示形式だけを列単位で設定する
+    # (列ごとではなく1回の batchUpdate にまとめる。既に設定済みでも毎回送るが、結果は変わらない)
+    # ※ repeatCell には sheetId が必要なので、シート情報の取得(読み込み)が1回増える
+    sheet_id = spreadsheet.worksheet(sheet_name).id
+    spreadsheet.batch_update({'requests': [
+        {'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': 1,
+                # HEADER は B列から始まるので +1
+                'startColumnIndex': HEADER.index(col) + 1,
+                'endColumnIndex': HEADER.index(col) + 2,
+            },
+            'cell': {'userEnteredFormat': {'numberFormat': {'type': 'PERCENT', 'pattern': '0.00%'}}},
+            'fields': 'userEnteredFormat.numberFormat',
+        }}
+        for col in PERCENT_COLUMNS
+    ]})
     
     print("Done.")
 